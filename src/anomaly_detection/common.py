@@ -10,24 +10,32 @@ import torch.nn.functional as F
 
 
 class FaissNN(object):
-    def __init__(self, on_gpu: bool = False, num_workers: int = 4, device=0) -> None:
+    def __init__(self, on_gpu: bool = False, num_workers: int = 4, device=0, approximate_above: int = None, quantize: bool = False) -> None:
         """FAISS Nearest neighbourhood search.
 
         Args:
             on_gpu: If set true, nearest neighbour searches are done on GPU.
             num_workers: Number of workers to use with FAISS for similarity search.
+            approximate_above: [optional] Number of indexed features above which
+                an IVF-PQ index shortlists the neighbours, which are then re-ranked
+                with exact distances.
+            quantize: If set true, exhaustive search runs over 8-bit scalar
+                quantized features (float16 on GPU).
         """
         faiss.omp_set_num_threads(num_workers)
         self.on_gpu = on_gpu
         self.search_index = None
 
         self.device = device
+        self.approximate_above = approximate_above
+        self.quantize = quantize
 
     def _gpu_cloner_options(self):
         return faiss.GpuClonerOptions()
 
     def _index_to_gpu(self, index):
-        if self.on_gpu:
+        # faiss has no GPU version of the refine index, it stays on the host
+        if self.on_gpu and not isinstance(index, faiss.IndexRefine):
             # For the non-gpu faiss python package, there is no GpuClonerOptions
             # so we can not make a default in the function header.
             return faiss.index_cpu_to_gpu(
@@ -36,7 +44,7 @@ class FaissNN(object):
         return index
 
     def _index_to_cpu(self, index):
-        if self.on_gpu:
+        if self.on_gpu and not isinstance(index, faiss.IndexRefine):
             return faiss.index_gpu_to_cpu(index)
         return index
 
@@ -44,9 +52,15 @@ class FaissNN(object):
         if self.on_gpu:
             cfg = faiss.GpuIndexFlatConfig()
             cfg.device = self.device
+            # GPU flat indexes have no 8-bit storage, half precision is the closest option
+            cfg.useFloat16 = self.quantize
             return faiss.GpuIndexFlatL2(
                 faiss.StandardGpuResources(), dimension, cfg
             )
+        if self.quantize:
+            return faiss.IndexScalarQuantizer(
+                dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2
+            )
         return faiss.IndexFlatL2(dimension)
 
     def fit(self, features: np.ndarray) -> None:
@@ -58,12 +72,43 @@ class FaissNN(object):
         """
         if self.search_index:
             self.reset_index()
-        self.search_index = self._create_index(features.shape[-1])
-        self._train(self.search_index, features)
-        self.search_index.add(features)
+        if self._use_approximate_index(features):
+            self.search_index = self._create_approximate_index(*features.shape)
+            self.search_index.train(features)
+        else:
+            self.search_index = self._create_index(features.shape[-1])
+            self._train(self.search_index, features)
+        self._add(self.search_index, features)
+
+    def _use_approximate_index(self, features):
+        # product quantization splits vectors into sub-quantizers of equal size
+        return (
+            self.approximate_above is not None
+            and len(features) > self.approximate_above
+            and features.shape[-1] % 16 == 0
+        )
 
-    def _train(self, _index, _features):
-        pass
+    def _create_approximate_index(self, n_features, dimension):
+        index = faiss.IndexIVFPQ(
+            faiss.IndexFlatL2(dimension),
+            dimension,
+            int(np.sqrt(n_features)),  # n_centroids
+            16,  # sub-quantizers
+            8,  # nbits per code
+        )
+        index.nprobe = 32
+        # PQ distances only shortlist candidates, anomaly scores come from exact L2
+        index = faiss.IndexRefineFlat(index)
+        index.k_factor = 64
+        return index
+
+    def _train(self, index, features):
+        # e.g. scalar quantizers learn their per-dimension ranges here
+        if not index.is_trained:
+            index.train(features)
+
+    def _add(self, index, features):
+        index.add(features)
 
     def run(
         self,
@@ -84,7 +129,7 @@ class FaissNN(object):
         # Build a search index just for this search.
         search_index = self._create_index(index_features.shape[-1])
         self._train(search_index, index_features)
-        search_index.add(index_features)
+        self._add(search_index, index_features)
         return search_index.search(query_features, n_nearest_neighbours)
 
     def save(self, filename: str) -> None:
@@ -119,6 +164,36 @@ class ApproximateFaissNN(FaissNN):
         return self._index_to_gpu(index)
 
 
+class CagraFaissNN(FaissNN):
+    def __init__(self, num_workers: int = 4, device=0) -> None:
+        """FAISS graph-based (CAGRA) nearest neighbourhood search on GPU.
+
+        Args:
+            num_workers: Number of workers to use with FAISS for similarity search.
+            device: Index of the GPU holding the search graph.
+        """
+        super().__init__(True, num_workers, device)
+
+    @staticmethod
+    def is_available():
+        # CAGRA is only exposed by GPU faiss builds compiled against cuVS.
+        return hasattr(faiss, "GpuIndexCagra")
+
+    def _create_index(self, dimension):
+        cfg = faiss.GpuIndexCagraConfig()
+        cfg.device = self.device
+        return faiss.GpuIndexCagra(
+            faiss.StandardGpuResources(), dimension, faiss.METRIC_L2, cfg
+        )
+
+    def _train(self, index, features):
+        # The search graph is built from the training features.
+        index.train(features)
+
+    def _add(self, index, features):
+        pass
+
+
 class _BaseMerger:
     def __init__(self):
         """Merges feature embedding by name."""
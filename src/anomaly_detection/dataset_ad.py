@@ -1,5 +1,6 @@
 import os
 import glob
+import hashlib
 import numpy as np
 import torch
 
@@ -12,11 +13,10 @@ class DatasetAnomalyDetection(torch.utils.data.Dataset):
         self.data, self.gt = self.load_data()
 
     def __getitem__(self, idx):
-        data = np.load(self.data[idx])
-        gt_heatmap = np.load(self.gt[idx]) if len(self.gt) else np.zeros_like(data)
+        gt_heatmap = self.gt[idx]
         is_anom = np.any(gt_heatmap)
         return {
-            "data": torch.tensor(data, dtype=torch.float).unsqueeze(1),
+            "data": self.data[idx].unsqueeze(1),
             "gt_heatmap": gt_heatmap,
             "is_anomaly": is_anom
         }
@@ -24,12 +24,28 @@ class DatasetAnomalyDetection(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.data)
 
+    def fingerprint(self):
+        """Digest of the preloaded windows, used to key cached features."""
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(repr((tuple(self.data.shape), str(self.data.dtype))).encode())
+        hasher.update(self.data.numpy().tobytes())
+        return hasher.hexdigest()
+
     def load_data(self):
+        """Preloads all windows in a single float tensor, from each folder's bundle (data.npz) if present, otherwise from one .npy file per window."""
         data = []
         gt = []
         for root_dir in self.data_folders_paths:
-            data.extend(glob.glob(os.path.join(root_dir, "data", "*.npy")))
-            gt.extend(glob.glob(os.path.join(root_dir, "gt", "*.npy")))
+            bundle_path = os.path.join(root_dir, "data.npz")
+            if os.path.exists(bundle_path):
+                with np.load(bundle_path) as bundle:
+                    data.extend(bundle["data"])
+                    gt.extend(bundle["gt"])
+                continue
+            data.extend(np.load(path) for path in glob.glob(os.path.join(root_dir, "data", "*.npy")))
+            gt.extend(np.load(path) for path in glob.glob(os.path.join(root_dir, "gt", "*.npy")))
         if len(data) == 0: 
             raise ValueError("No data found in the specified directory")
-        return data, gt
+        data = np.stack(data).astype(np.float32, copy=False)
+        gt = np.stack(gt) if len(gt) else np.zeros_like(data)
+        return torch.from_numpy(data), gt
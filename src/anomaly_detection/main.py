@@ -28,12 +28,14 @@ def parse_args():
     parser.add_argument("--save_model",         type=bool,           default=True)
     parser.add_argument("--model_save_path",    type=str,            default="results/weights")
     parser.add_argument("--results_file",       type=str,            default="results/results.txt",                 help="Path to file to save results in")
+    parser.add_argument("--features_cache_dir", type=str,            default=None,                                  help="Folder to cache training features in, disabled if not set")
     parser.add_argument("--eval_plots_path",    type=str,            default="results/Park/Commercial/30_minutes",  help="Path to file to save generated plots in")
     # dataset
     parser.add_argument("--train_data_path",    type=str, nargs='+', default=["dataset/processed/Park/Commercial/30_minutes/ad_train_contam", "dataset/processed/Park/Commercial/30_minutes/ad_test_contam"], help="List of training data paths") # we flag anomalies on the whole dataset for the pipeline
     parser.add_argument("--test_data_path",     type=str, nargs='+', default=["dataset/processed/Park/Commercial/30_minutes/ad_train_contam", "dataset/processed/Park/Commercial/30_minutes/ad_test_contam"], help="List of training data paths")
     parser.add_argument("--nbr_timesteps",      type=int,            default=48*1)  # sequence length
     parser.add_argument("--batch_size",         type=int,            default=32)
+    parser.add_argument("--num_workers",        type=int,            default=4,     help="Number of workers loading training batches")
     parser.add_argument("--nbr_variables",      type=int,            default=1)     # uni-variate
     parser.add_argument("--nbr_features",       type=int,            default=3)     # set according to feature extraction module
     parser.add_argument("--contam_ratio",       type=float,          default=0.1, help="Estimated day contamination rate of the dataset (percentage of days with any anomaly)") # 0.02 for INPG; 0.05 for Yahoo
@@ -42,12 +44,17 @@ def parse_args():
     parser.add_argument("--feat_patch_size",    type=int,            default=8)     # set according to layer_to_extract_from
     # backbone
     parser.add_argument("--backbone_name",      type=str,            default="resnet50")
+    parser.add_argument("--compile_backbone",   action="store_true")
     parser.add_argument("--backbone_layers_to_extract_from", "-le",  type=str, action="append", default=["layer1"])
     # coreset sampler
     parser.add_argument("--sampler_name",       type=str,            default="approx_greedy_coreset")
     parser.add_argument("--sampling_ratio",     type=float,          default=0.1)
+    parser.add_argument("--coreset_method",     type=str,            default="greedy", help="Coreset selection: greedy or kmeans")
     parser.add_argument("--faiss_on_gpu",       action="store_true")
     parser.add_argument("--faiss_num_workers",  type=int,            default=4)
+    parser.add_argument("--faiss_quantize",     action="store_true",                    help="Store the coreset index with 8-bit scalar quantization (float16 on GPU) instead of float32")
+    parser.add_argument("--faiss_approximate_above", type=int,       default=None,  help="Coreset size above which an IVF-PQ index shortlists neighbours before exact re-ranking (default: always exhaustive search)")
+    parser.add_argument("--faiss_index",        type=str,            default="auto", choices=["auto", "cagra"], help="auto: exhaustive/IVF-PQ index, cagra: GPU graph index (needs a cuVS faiss build)")
     # SoftPatch hyper-parameter
     parser.add_argument("--weight_method",      type=str,            default="gaussian")
     parser.add_argument("--threshold",          type=float,          default=0.2)   # denoising parameter
@@ -70,6 +77,9 @@ def get_dataloaders(args):
         batch_size=args.batch_size,
         shuffle=False,
         pin_memory=True,
+        num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+        prefetch_factor=4 if args.num_workers > 0 else None,
     )
     test_dataloader = torch.utils.data.DataLoader(
         test_dataset,
@@ -106,9 +116,16 @@ def get_coreset(args, device):
 
     backbone = get_backbone(args)
     sampler = get_sampler(args.sampler_name, args.sampling_ratio, device)
-    nn_method = common.FaissNN(
-        args.faiss_on_gpu, args.faiss_num_workers, device=device.index
-    )
+    if args.faiss_index == "cagra":
+        if device.type != "cuda" or not common.CagraFaissNN.is_available():
+            raise ValueError("CAGRA index requires a GPU and a faiss build with cuVS support")
+        nn_method = common.CagraFaissNN(args.faiss_num_workers, device=device.index or 0)
+    else:
+        nn_method = common.FaissNN(
+            args.faiss_on_gpu, args.faiss_num_workers, device=device.index,
+            approximate_above=args.faiss_approximate_above,
+            quantize=args.faiss_quantize,
+        )
 
     coreset_instance = softpatch.SoftPatch(device)
     coreset_instance.load(
@@ -123,7 +140,10 @@ def get_coreset(args, device):
         LOF_k=args.lof_k,
         threshold=args.threshold,
         weight_method=args.weight_method,
+        coreset_method=args.coreset_method,
         soft_weight_flag=not args.without_soft_weight,
+        features_cache_dir=args.features_cache_dir,
+        compile_backbone=args.compile_backbone,
     )
     return coreset_instance
 
@@ -1,6 +1,7 @@
 import abc
 from typing import Union
 
+import faiss
 import numpy as np
 import torch
 import tqdm
@@ -208,4 +209,47 @@ class WeightedGreedyCoresetSampler(ApproximateGreedyCoresetSampler):
         self.sampling_weight = None
 
     def set_sampling_weight(self, sampling_weight):
+        """Sets the [N] mask of features that can be sampled, as a bool or 0/1 tensor."""
         self.sampling_weight = sampling_weight
+
+
+class WeightedKMeansCoresetSampler(WeightedGreedyCoresetSampler):
+    def __init__(
+        self,
+        percentage: float,
+        device: torch.device,
+        niter: int = 20,
+        dimension_to_project_features_to: int = 128,
+    ):
+        """k-means Coreset sampling, keeps the feature closest to each centroid."""
+        self.niter = niter
+        super().__init__(percentage, device, dimension_to_project_features_to=dimension_to_project_features_to)
+
+    def _compute_greedy_coreset_indices(self, features: torch.Tensor) -> np.ndarray:
+        """Runs k-means on the feature bank instead of iterative greedy selection.
+
+        Features flagged as noisy by the sampling weight are left out of both
+        the clustering and the centroid assignment.
+
+        Args:
+            features: [NxD] input feature bank to sample.
+        """
+        candidate_indices = np.arange(len(features))
+        if self.sampling_weight is not None:
+            candidate_indices = torch.nonzero(self.sampling_weight).squeeze(-1).cpu().numpy()
+        candidates = np.ascontiguousarray(
+            features[candidate_indices].detach().cpu().numpy(), dtype=np.float32
+        )
+        num_coreset_samples = min(int(len(features) * self.percentage), len(candidates))
+
+        on_gpu = torch.device(self.device).type == "cuda" and hasattr(faiss, "StandardGpuResources")
+        kmeans = faiss.Kmeans(
+            candidates.shape[1], num_coreset_samples, niter=self.niter, gpu=on_gpu
+        )
+        kmeans.train(candidates)
+
+        index = faiss.IndexFlatL2(candidates.shape[1])
+        index.add(candidates)
+        _, nearest_indices = index.search(kmeans.centroids, 1)
+
+        return candidate_indices[np.unique(nearest_indices[:, 0])]
@@ -1,10 +1,13 @@
 import os
+import json
+import hashlib
 import logging
 import tqdm
 import pickle
 import numpy as np
 import torch
 import torch.nn.functional as F
+from joblib import Parallel, delayed
 from sklearn.neighbors import LocalOutlierFactor
 
 import common
@@ -40,8 +43,10 @@ class SoftPatch(torch.nn.Module):
         ),
         nn_method=common.FaissNN(False, 4),
         lof_k=5,
+        lof_chunk_min_patches=400,
         threshold=0.15,
         weight_method="lof",
+        coreset_method="greedy",
         soft_weight_flag=True,
         coreset_weight = None,
         min_score=None,
@@ -49,6 +54,8 @@ class SoftPatch(torch.nn.Module):
         min_heatmap_scores=None,
         max_heatmap_scores=None,
         window_threshold=None,
+        features_cache_dir=None,
+        compile_backbone=False,
         **kwargs,
     ):
         self.device = device
@@ -66,6 +73,9 @@ class SoftPatch(torch.nn.Module):
             self.backbone, self.layers_to_extract_from, self.device
         )
         feature_dimensions = feature_aggregator.feature_dimensions(input_shape)
+        if compile_backbone:
+            # compiled once here and reused by both fit and predict
+            feature_aggregator = torch.compile(feature_aggregator, dynamic=False)
         self.forward_modules["feature_aggregator"] = feature_aggregator
 
         preprocessing = common.Preprocessing(
@@ -89,11 +99,18 @@ class SoftPatch(torch.nn.Module):
         self.featuresampler = featuresampler
 
         #------ SoftPatch ------#
-        self.featuresampler = sampler.WeightedGreedyCoresetSampler(featuresampler.percentage,
-                                                                   featuresampler.device)
+        if coreset_method == "greedy":
+            self.featuresampler = sampler.WeightedGreedyCoresetSampler(featuresampler.percentage,
+                                                                       featuresampler.device)
+        elif coreset_method == "kmeans":
+            self.featuresampler = sampler.WeightedKMeansCoresetSampler(featuresampler.percentage,
+                                                                       featuresampler.device)
+        else:
+            raise ValueError("Unexpected coreset method")
         self.patch_weight = None
         self.feature_shape = []
         self.lof_k = lof_k
+        self.lof_chunk_min_patches = lof_chunk_min_patches
         self.threshold = threshold
         self.weight_method = weight_method
         self.soft_weight_flag = soft_weight_flag
@@ -104,6 +121,7 @@ class SoftPatch(torch.nn.Module):
         self.min_heatmap_scores = min_heatmap_scores
         self.max_heatmap_scores = max_heatmap_scores
         self.window_threshold = window_threshold
+        self.features_cache_dir = features_cache_dir
 
     def embed(self, data):
         if isinstance(data, torch.utils.data.DataLoader):
@@ -131,11 +149,13 @@ class SoftPatch(torch.nn.Module):
             self.alpha
         )
         
+        # bfloat16 autocast on GPUs that support it, features are cast back to float32 below
+        amp_dtype = _backbone_autocast_dtype(ts_features.device)
         _ = self.forward_modules["feature_aggregator"].eval()
-        with torch.no_grad():
+        with torch.no_grad(), torch.autocast("cuda", dtype=torch.bfloat16, enabled=amp_dtype is not None):
             backbone_features = self.forward_modules["feature_aggregator"](ts_features)
 
-        features = [backbone_features[layer] for layer in self.layers_to_extract_from]
+        features = [backbone_features[layer].float() for layer in self.layers_to_extract_from]
 
         features = [
             self.patch_maker.patchify(x, return_spatial_info=True) for x in features
@@ -149,24 +169,20 @@ class SoftPatch(torch.nn.Module):
             _features = features[i]
             patch_dims = patch_shapes[i]
 
+            # bxLxcxpxp -> bx(c*p*p)xhxw, so all channels are resized in one call
+            patch_feature_shape = _features.shape[2:]
             _features = _features.reshape(
-                _features.shape[0], patch_dims[0], patch_dims[1], *_features.shape[2:]
+                _features.shape[0], patch_dims[0], patch_dims[1], -1
             )
-            _features = _features.permute(0, -3, -2, -1, 1, 2)
-            perm_base_shape = _features.shape
-            _features = _features.reshape(-1, *_features.shape[-2:])
+            _features = _features.permute(0, 3, 1, 2)
             _features = F.interpolate(
-                _features.unsqueeze(1),
+                _features,
                 size=(ref_num_patches[0], ref_num_patches[1]),
                 mode="bilinear",
                 align_corners=False,
             )
-            _features = _features.squeeze(1)
-            _features = _features.reshape(
-                *perm_base_shape[:-2], ref_num_patches[0], ref_num_patches[1]
-            )
-            _features = _features.permute(0, -2, -1, 1, 2, 3)
-            _features = _features.reshape(len(_features), -1, *_features.shape[-3:])
+            _features = _features.permute(0, 2, 3, 1)
+            _features = _features.reshape(len(_features), -1, *patch_feature_shape)
             features[i] = _features
         features = [x.reshape(-1, *x.shape[-3:]) for x in features]
 
@@ -192,36 +208,95 @@ class SoftPatch(torch.nn.Module):
 
         def _timeserie_to_features(input_timeserie):
             with torch.no_grad():
-                input_timeserie = input_timeserie.to(torch.float).to(self.device)
-                return self._embed(input_timeserie)
-
-        features = []
-        with tqdm.tqdm(
-            input_data, desc="Computing support features...", leave=True
-        ) as data_iterator:
-            for timeserie in data_iterator:
-                if isinstance(timeserie, dict):
-                    timeserie = timeserie["data"]
-                features.append(_timeserie_to_features(timeserie))
-
-        features = np.concatenate(features, axis=0)
+                # copy from pinned memory asynchronously, before any host-side dtype conversion
+                input_timeserie = input_timeserie.to(self.device, non_blocking=True).to(torch.float)
+                return self._embed(input_timeserie, detach=False, provide_patch_shapes=True)
+
+        cache_paths = self._features_cache_paths(input_data)
+        if cache_paths is not None and all(os.path.exists(path) for path in cache_paths):
+            LOGGER.info("Loading cached support features.")
+            features = torch.from_numpy(np.load(cache_paths[0])).to(self.device)
+            with open(cache_paths[1], "r") as load_file:
+                self.feature_shape = json.load(load_file)["feature_shape"]
+        else:
+            features = []
+            with tqdm.tqdm(
+                input_data, desc="Computing support features...", leave=True
+            ) as data_iterator:
+                for timeserie in data_iterator:
+                    if isinstance(timeserie, dict):
+                        timeserie = timeserie["data"]
+                    _features, patch_shapes = _timeserie_to_features(timeserie)
+                    features.append(_features)
+
+            # features stay on device, they are only moved to host once the coreset is selected
+            features = torch.cat(features, dim=0)
+            self.feature_shape = patch_shapes[0]
+            if cache_paths is not None:
+                self._save_features_cache(cache_paths, features)
 
         with torch.no_grad():
-            self.feature_shape = self._embed(timeserie.to(torch.float).to(self.device), provide_patch_shapes=True)[1][0]
             patch_weight = self._compute_patch_weight(features)
 
             patch_weight = patch_weight.reshape(-1)
             threshold = torch.quantile(patch_weight, 1 - self.threshold)
-            sampling_weight = torch.where(patch_weight > threshold, 0, 1) # denoising
+            sampling_weight = ~(patch_weight > threshold) # denoising, bool mask of the patches kept for sampling
             self.featuresampler.set_sampling_weight(sampling_weight)
             self.patch_weight = patch_weight.clamp(min=0)
 
             sample_features, sample_indices = self.featuresampler.run(features) 
             self.coreset_weight = self.patch_weight[sample_indices].cpu().numpy()
 
-        self.anomaly_scorer.fit(detection_features=[sample_features])
+        self.anomaly_scorer.fit(detection_features=[sample_features.cpu().numpy()])
+
+    def _features_cache_paths(self, input_data):
+        """Returns the (features, metadata) cache files of a dataset, None if caching is disabled."""
+        if self.features_cache_dir is None:
+            return None
+        # the dataset must identify its content explicitly, caching is skipped (not silently wrong) otherwise
+        fingerprint = getattr(getattr(input_data, "dataset", None), "fingerprint", None)
+        if fingerprint is None:
+            LOGGER.warning("Features cache disabled: the training dataset has no fingerprint() method.")
+            return None
+
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(fingerprint().encode())
+        backbone_name = (getattr(self.backbone, "pretrained_cfg", None) or {}).get(
+            "architecture", type(self.backbone).__name__
+        )
+        embedding_config = (
+            backbone_name,
+            list(self.layers_to_extract_from),
+            self.patch_maker.patchsize,
+            self.patch_maker.stride,
+            list(self.input_shape),
+            self.feat_patch_size,
+            self.alpha,
+            self.forward_modules["preprocessing"].output_dim,
+            self.target_embed_dimension,
+            torch.device(self.device).type,
+            str(_backbone_autocast_dtype(self.device)), # bf16 features must not be reused by float32 runs
+        )
+        hasher.update(repr(embedding_config).encode())
+        key = hasher.hexdigest()
+
+        return (
+            os.path.join(self.features_cache_dir, key + ".npy"),
+            os.path.join(self.features_cache_dir, key + ".json"),
+        )
 
-    def _compute_patch_weight(self, features: np.ndarray):
+    def _save_features_cache(self, cache_paths, features):
+        os.makedirs(self.features_cache_dir, exist_ok=True)
+        features_path, metadata_path = cache_paths
+        # write to temporary files then rename, so an interrupted run never leaves a partial cache
+        with open(features_path + ".tmp", "wb") as save_file:
+            np.save(save_file, features.cpu().numpy())
+        with open(metadata_path + ".tmp", "w") as save_file:
+            json.dump({"feature_shape": list(self.feature_shape)}, save_file)
+        os.replace(features_path + ".tmp", features_path)
+        os.replace(metadata_path + ".tmp", metadata_path)
+
+    def _compute_patch_weight(self, features: torch.Tensor):
         if isinstance(features, np.ndarray):
             features = torch.from_numpy(features)
 
@@ -231,10 +306,13 @@ class SoftPatch(torch.nn.Module):
 
         patch_features = patch_features.permute(1, 0, 2)
 
-        if self.weight_method == "lof":
-            patch_weight = self._compute_lof(self.lof_k, patch_features).transpose(-1, -2) 
-        elif self.weight_method == "lof_gpu":
-            patch_weight = self._compute_lof_gpu(self.lof_k, patch_features).transpose(-1, -2)
+        if self.weight_method in ("lof", "lof_gpu") and patch_features.shape[0] > self.lof_chunk_min_patches:
+            patch_weight = self._chunk_lof(
+                self.lof_k, patch_features.reshape(*self.feature_shape, *patch_features.shape[1:])
+            )
+            patch_weight = patch_weight.reshape(patch_features.shape[:2]).transpose(-1, -2)
+        elif self.weight_method in ("lof", "lof_gpu"):
+            patch_weight = self._select_lof(self.lof_k, patch_features).transpose(-1, -2)
         elif self.weight_method == "nearest":
             patch_weight = self._compute_nearest_distance(patch_features).transpose(-1, -2)
             patch_weight = patch_weight + 1
@@ -268,68 +346,93 @@ class SoftPatch(torch.nn.Module):
 
         return distances
 
-    def _compute_nearest_distance(self, embedding: torch.Tensor) -> torch.Tensor:
-        patch, batch, _ = embedding.shape
+    @staticmethod
+    def _compute_distance_matrix(embedding: torch.Tensor) -> torch.Tensor:
+        """Pairwise L2 distances between the embeddings of each patch, in float32.
 
-        x_x = (embedding ** 2).sum(dim=-1, keepdim=True).expand(patch, batch, batch)
-        dist_mat = (x_x + x_x.transpose(-1, -2) - 2 * embedding.matmul(embedding.transpose(-1, -2))).abs() ** 0.5
+        cdist expands ||a||^2 + ||b||^2 - 2ab for large inputs, which cancels catastrophically in
+        reduced precision and scrambles the neighbour rankings LOF relies on.
+        """
+        embedding = embedding.float()
+        return torch.cdist(embedding, embedding)
+
+    def _compute_nearest_distance(self, embedding: torch.Tensor) -> torch.Tensor:
+        dist_mat = self._compute_distance_matrix(embedding)
         nearest_distance = torch.topk(dist_mat, dim=-1, largest=False, k=2)[0].sum(dim=-1)  #
         return nearest_distance
 
     def _compute_lof(self, k, embedding: torch.Tensor) -> torch.Tensor:
         patch, batch, _ = embedding.shape   # 784x219x128
-        clf = LocalOutlierFactor(n_neighbors=int(k), metric='l2')
-        scores = torch.zeros(size=(patch, batch), device=embedding.device)
-        for i in range(patch):
-            clf.fit(embedding[i].cpu())
-            scores[i] = torch.Tensor(- clf.negative_outlier_factor_)
-        return scores
-
-    def _compute_lof_gpu(self, k, embedding: torch.Tensor) -> torch.Tensor:
+        # patches are independent, fit them in parallel on all cores
+        np_embedding = np.ascontiguousarray(embedding.detach().cpu().numpy(), dtype=np.float32)
+        patch_scores = Parallel(n_jobs=-1, backend="loky")(
+            delayed(_fit_patch_lof)(k, np_embedding[i]) for i in range(patch)
+        )
+        scores = torch.from_numpy(np.stack(patch_scores).astype(np.float32))
+        return scores.to(embedding.device)
+
+    def _compute_lof_gpu(self, k, embedding: torch.Tensor, patch_chunk_size=64) -> torch.Tensor:
         """
-        GPU support
+        GPU support, patches are processed in chunks as the distance matrix is patch x batch x batch
         """
+        embedding = embedding.to(self.device)
+        lof_chunks = [
+            self._compute_lof_chunk(k, embedding_chunk)
+            for embedding_chunk in embedding.split(patch_chunk_size, dim=0)
+        ]
+        return torch.cat(lof_chunks, dim=0)
 
+    def _compute_lof_chunk(self, k, embedding: torch.Tensor) -> torch.Tensor:
         patch, batch, _ = embedding.shape
 
-        # calculate distance
-        x_x = (embedding ** 2).sum(dim=-1, keepdim=True).expand(patch, batch, batch)
-        dist_mat = (x_x + x_x.transpose(-1, -2) - 2 * embedding.matmul(embedding.transpose(-1, -2))).abs() ** 0.5 + 1e-6
+        # calculate distance, a sample is excluded from its own neighborhood
+        dist_mat = self._compute_distance_matrix(embedding) + 1e-6
+        dist_mat.diagonal(dim1=-2, dim2=-1).fill_(float("inf"))
 
-        # find neighborhoods
-        top_k_distance_mat, top_k_index = torch.topk(dist_mat, dim=-1, largest=False, k=k + 1)
-        top_k_distance_mat, top_k_index = top_k_distance_mat[:, :, 1:], top_k_index[:, :, 1:]
-        k_distance_value_mat = top_k_distance_mat[:, :, -1]
+        # find neighborhoods, unsorted as the k-distance is the largest neighbor distance
+        top_k_distance_mat, top_k_index = torch.topk(dist_mat, dim=-1, largest=False, k=k, sorted=False)
+        k_distance_value_mat = top_k_distance_mat.max(dim=-1).values
+        flat_top_k_index = top_k_index.reshape(patch, batch * k)
 
-        # calculate reachability distance
-        reach_dist_mat = torch.max(dist_mat, k_distance_value_mat.unsqueeze(2).expand(patch, batch, batch)
-                                   .transpose(-1, -2))  # Transposing is important
-        top_k_index_hot = torch.zeros(size=dist_mat.shape, device=top_k_index.device).scatter_(-1, top_k_index, 1)
+        # calculate reachability distance to each neighbor: max(d(p, o), k-distance(o))
+        neighbor_k_distance = torch.gather(k_distance_value_mat, 1, flat_top_k_index).reshape(patch, batch, k)
+        reach_dist_mat = torch.max(top_k_distance_mat, neighbor_k_distance)
 
         # Local reachability density
-        lrd_mat = k / (top_k_index_hot * reach_dist_mat).sum(dim=-1)
+        lrd_mat = k / reach_dist_mat.sum(dim=-1)
 
         # calculate local outlier factor
-        lof_mat = ((lrd_mat.unsqueeze(2).expand(patch, batch, batch).transpose(-1, -2) * top_k_index_hot).sum(
-            dim=-1) / k) / lrd_mat
+        neighbor_lrd_mat = torch.gather(lrd_mat, 1, flat_top_k_index).reshape(patch, batch, k)
+        lof_mat = (neighbor_lrd_mat.sum(dim=-1) / k) / lrd_mat
         return lof_mat
 
 
-    def _chunk_lof(self, k, embedding: torch.Tensor) -> torch.Tensor:
+    def _select_lof(self, k, embedding: torch.Tensor) -> torch.Tensor:
+        if self.weight_method == "lof" and torch.device(self.device).type == "cpu":
+            return self._compute_lof(k, embedding)
+        return self._compute_lof_gpu(k, embedding)
+
+    def _chunk_lof(self, k, embedding: torch.Tensor, cache_size=2 ** 20) -> torch.Tensor:
+        """
+        LOF over tiles of neighbouring patches, each tile's samples are fitted jointly.
+        The tile side is chosen so a tile's embeddings (tile² x batch x channel floats) fit in cache_size bytes,
+        the output has the same width x height x batch layout as the input.
+        """
         width, height, batch, channel = embedding.shape
-        chunk_size = 2
+        chunk_size = max(1, int((cache_size / (batch * channel * 4)) ** 0.5))
+        # largest tile side that evenly divides each dimension (e.g. height 1 for univariate series)
+        chunk_w = max(c for c in range(1, min(chunk_size, width) + 1) if width % c == 0)
+        chunk_h = max(c for c in range(1, min(chunk_size, height) + 1) if height % c == 0)
 
-        new_width, new_height = int(width / chunk_size), int(height / chunk_size)
+        new_width, new_height = width // chunk_w, height // chunk_h
         new_patch = new_width * new_height
-        new_batch = batch * chunk_size * chunk_size
-
-        split_width = torch.stack(embedding.split(chunk_size, dim=0), dim=0)
-        split_height = torch.stack(split_width.split(chunk_size, dim=1 + 1), dim=1)
+        new_batch = batch * chunk_w * chunk_h
 
-        new_embedding = split_height.view(new_patch, new_batch, channel)
-        lof_mat = self._compute_lof(k, new_embedding)
-        chunk_lof_mat = lof_mat.reshape(new_width, new_height, chunk_size, chunk_size, batch)
-        chunk_lof_mat = chunk_lof_mat.transpose(1, 2).reshape(width, height, batch)
+        tiles = embedding.reshape(new_width, chunk_w, new_height, chunk_h, batch, channel)
+        new_embedding = tiles.permute(0, 2, 1, 3, 4, 5).reshape(new_patch, new_batch, channel)
+        lof_mat = self._select_lof(k, new_embedding)
+        chunk_lof_mat = lof_mat.reshape(new_width, new_height, chunk_w, chunk_h, batch)
+        chunk_lof_mat = chunk_lof_mat.permute(0, 2, 1, 3, 4).reshape(width, height, batch)
         return chunk_lof_mat
 
 
@@ -449,6 +552,20 @@ class SoftPatch(torch.nn.Module):
         self.anomaly_scorer.load(load_path, prepend)
 
 
+def _backbone_autocast_dtype(device):
+    """Returns the autocast dtype the backbone runs under on device, None if it runs in float32."""
+    if torch.device(device).type == "cuda" and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return None
+
+
+def _fit_patch_lof(k, patch_embedding):
+    """Returns the local outlier factor of every sample of one patch."""
+    clf = LocalOutlierFactor(n_neighbors=int(k), metric='l2')
+    clf.fit(patch_embedding)
+    return - clf.negative_outlier_factor_
+
+
 class PatchMaker:
     def __init__(self, patchsize, stride=None):
         self.patchsize = patchsize
@@ -463,20 +580,22 @@ class PatchMaker:
             patchsize]
         """
         padding = int((self.patchsize - 1) / 2)
-        unfolder = torch.nn.Unfold(
-            kernel_size=self.patchsize, stride=self.stride, padding=padding, dilation=1
-        )
-        unfolded_features = unfolder(features)
         number_of_total_patches = []
         for side in features.shape[-2:]:
             n_patches = (
                 side + 2 * padding - 1 * (self.patchsize - 1) - 1
             ) / self.stride + 1
             number_of_total_patches.append(int(n_patches))
+        # strided views, patches are only materialized by the final reshape
+        padded_features = F.pad(features, [padding] * 4)
+        unfolded_features = padded_features.unfold(
+            2, self.patchsize, self.stride
+        ).unfold(3, self.patchsize, self.stride)
+        # bs x c x w' x h' x p x p -> bs x w'*h' x c x p x p
+        unfolded_features = unfolded_features.permute(0, 2, 3, 1, 4, 5)
         unfolded_features = unfolded_features.reshape(
-            *features.shape[:2], self.patchsize, self.patchsize, -1
+            features.shape[0], -1, features.shape[1], self.patchsize, self.patchsize
         )
-        unfolded_features = unfolded_features.permute(0, 4, 1, 2, 3)
 
         if return_spatial_info:
             return unfolded_features, number_of_total_patches
@@ -490,8 +609,8 @@ class PatchMaker:
         if isinstance(timeserie_scores, np.ndarray):
             was_numpy = True
             timeserie_scores = torch.from_numpy(timeserie_scores)
-        while timeserie_scores.ndim > 1:
-            timeserie_scores = torch.max(timeserie_scores, dim=-1).values
+        if timeserie_scores.ndim > 1:
+            timeserie_scores = timeserie_scores.amax(dim=tuple(range(1, timeserie_scores.ndim)))
         if was_numpy:
             return timeserie_scores.numpy()
         return timeserie_scores
@@ -104,14 +104,19 @@ class LSTM_AE(nn.Module):
         decoded = self.decoder(encoded)
         return encoded, decoded
     
-    def fit(self, train_loader, test_dataloader):
+    def fit(self, train_loader, test_dataloader, amp=True):
         """
         trains the model's parameters over a fixed number of epochs, specified by `n_epochs`, as long as the loss keeps decreasing.
         :param dataset: `Dataset` object
         :param bool save: If true, dumps the trained model parameters as pickle file at `dload` directory
+        :param bool amp: If true, trains with mixed precision on GPU (bfloat16 when supported, float16 otherwise)
         :return:
         """
         optimizer = torch.optim.Adam(self.parameters(), lr = self.learning_rate)
+        use_amp = amp and self.device.type == "cuda"
+        amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported() else torch.float16
+        # loss scaling is only needed for float16, bfloat16 has the same exponent range as float32
+        scaler = torch.cuda.amp.GradScaler(enabled=use_amp and amp_dtype == torch.float16)
         self.train()
         # initialize the early_stopping object
         early_stopping = EarlyStopping(patience=self.patience, verbose=False, checkpoint_path=self.checkpoint_path)
@@ -127,25 +132,29 @@ class LSTM_AE(nn.Module):
                 masked_ts = batch["masked_data"].to(self.device)
                 mask = batch["mask"].to(self.device)
                 optimizer.zero_grad()
-                encoded, decoded = self(masked_ts)
+                with torch.autocast("cuda", dtype=amp_dtype, enabled=use_amp):
+                    encoded, decoded = self(masked_ts)
 
-                running_loss = self.criterion(clean_ts , decoded)                   # option 1: calculate loss for the whole sequence
-                # running_loss = self.criterion(clean_ts * mask, decoded * mask)    # option 2: only calculate loss for the masked part
+                    running_loss = self.criterion(clean_ts , decoded)                   # option 1: calculate loss for the whole sequence
+                    # running_loss = self.criterion(clean_ts * mask, decoded * mask)    # option 2: only calculate loss for the masked part
                 epoch_train_loss += running_loss.item()
 
                 # Backward pass
-                running_loss.backward()
+                scaler.scale(running_loss).backward()
+                scaler.unscale_(optimizer) # gradients are clipped at their true scale
                 nn.utils.clip_grad_norm_(self.parameters(), max_norm = self.max_grad_norm) # clipping avoids exploding gradients
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
             
             epoch_valid_loss = 0.0
             for batch in test_dataloader:
                 clean_ts = batch["clean_data"].to(self.device)
                 masked_ts = batch["masked_data"].to(self.device)
                 mask = batch["mask"].to(self.device)
-                encoded, decoded = self(masked_ts)
-                running_loss = self.criterion(clean_ts , decoded)                   # option 1: calculate loss for the whole sequence
-                # running_loss = self.criterion(clean_ts * mask, decoded * mask)    # option 2: only calculate loss for the masked part
+                with torch.autocast("cuda", dtype=amp_dtype, enabled=use_amp):
+                    encoded, decoded = self(masked_ts)
+                    running_loss = self.criterion(clean_ts , decoded)                   # option 1: calculate loss for the whole sequence
+                    # running_loss = self.criterion(clean_ts * mask, decoded * mask)    # option 2: only calculate loss for the masked part
                 epoch_valid_loss += running_loss.item()
             
             # early_stopping needs the validation loss to check if it has decresed, 
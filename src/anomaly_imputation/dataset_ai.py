@@ -13,7 +13,7 @@ class DatasetAnomalyImputation(torch.utils.data.Dataset):
         self.data = self.load_data()
 
     def __getitem__(self, idx):
-        ts = torch.tensor(np.load(self.data[idx]), dtype=torch.float)
+        ts = self.data[idx]
         mask = torch.ones_like(ts)
         mask_idx = np.random.randint(0, len(ts) - self.mask_size-1)
         mask[mask_idx: mask_idx+self.mask_size] = 0
@@ -28,5 +28,8 @@ class DatasetAnomalyImputation(torch.utils.data.Dataset):
         return len(self.data)
 
     def load_data(self):
-        data = glob.glob(os.path.join(self.root_dir, "*.npy"))
-        return data
+        """Preloads all windows in a single float tensor."""
+        data = [np.load(path) for path in glob.glob(os.path.join(self.root_dir, "*.npy"))]
+        if not len(data):
+            return torch.empty(0)
+        return torch.from_numpy(np.stack(data).astype(np.float32, copy=False))
@@ -23,13 +23,15 @@ def parse_args():
     parser.add_argument("--mask_size",           type=int,   default=8,                                             help="Length of the mask")
     parser.add_argument("--embedding_dim",       type=int,   default=128,                                           help="Dimension of embedding")
     parser.add_argument("--learning_rate",       type=float, default=1e-3,                                          help="Learning rate for the optimizer")
-    parser.add_argument("--batch_size",          type=float, default=32,                                            help="Batch size for training")
+    parser.add_argument("--batch_size",          type=int,   default=128,                                           help="Batch size for training")
+    parser.add_argument("--num_workers",         type=int,   default=4,                                             help="Number of data loading workers for training")
     parser.add_argument("--seed",                type=int,   default=0,                                             help="Random seed")
     parser.add_argument("--checkpoint_path",     type=str,   default="src/anomaly_imputation/checkpoint.pt",        help="Path to save checkpoint")
     # training params
     parser.add_argument("--epochs",              type=int,   default=500,                                           help="Number of training epochs")
     parser.add_argument("--patience",            type=int,   default=50,                                            help="Patience for early stopping")
     parser.add_argument("--max_grad_norm",       type=float, default=0.05,                                          help="Maximum gradient norm for gradient clipping")
+    parser.add_argument("--no_amp",              action="store_true",                                               help="Disable mixed precision training")
     # logging params
     parser.add_argument("--every_epoch_print",   type=int,   default=10,                                            help="Print results every n epochs")
     parser.add_argument("--save_eval_plots",     type=bool,  default=True,                                          help="Save evaluation plots")
@@ -37,7 +39,7 @@ def parse_args():
     return parser.parse_args()
 
 
-def get_data_loaders(dataset_root, split_ratio, mask_size, batch_size):
+def get_data_loaders(dataset_root, split_ratio, mask_size, batch_size, num_workers=4):
     dataset = DatasetAnomalyImputation(dataset_root,
                                         mask_size)
     train_dataset, test_dataset = torch.utils.data.random_split(dataset, [int(split_ratio * len(dataset)), len(dataset) - int(split_ratio * len(dataset))])
@@ -46,6 +48,9 @@ def get_data_loaders(dataset_root, split_ratio, mask_size, batch_size):
         batch_size=batch_size,
         shuffle=True,
         pin_memory=True,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
     )
     test_dataloader = torch.utils.data.DataLoader(
         test_dataset,
@@ -57,9 +62,9 @@ def get_data_loaders(dataset_root, split_ratio, mask_size, batch_size):
 
 
 def train(args, device):
-    train_dataloader, test_dataloader = get_data_loaders(args.dataset_root, args.split_ratio, args.mask_size, args.batch_size)
+    train_dataloader, test_dataloader = get_data_loaders(args.dataset_root, args.split_ratio, args.mask_size, args.batch_size, args.num_workers)
     model = LSTM_AE(args.seq_len, args.no_features, args.embedding_dim, args.learning_rate, args.every_epoch_print, args.epochs, args.patience, args.max_grad_norm, args.checkpoint_path, args.seed)
-    loss_history = model.fit(train_dataloader, test_dataloader)
+    loss_history = model.fit(train_dataloader, test_dataloader, amp=not args.no_amp)
     
     if args.save_eval_plots:
         plt.plot(loss_history)
@@ -1,17 +1,54 @@
 import os
-import subprocess
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
 
 save_folder = "dataset/raw/AEMO"
+n_workers = 32
+max_retries = 5
+
+# one persistent session per worker thread so TLS connections are reused across downloads
+thread_local = threading.local()
+
+
+def get_session():
+    if not hasattr(thread_local, "session"):
+        thread_local.session = requests.Session()
+    return thread_local.session
 
+
+def download(url, file_save_path):
+    for attempt in range(max_retries):
+        try:
+            response = get_session().get(url, timeout=60)
+            if response.status_code == 200:
+                with open(file_save_path, "wb") as f:
+                    f.write(response.content)
+                return
+            error = f"HTTP {response.status_code}"
+        except requests.RequestException as e:
+            error = str(e)
+        time.sleep(2 ** attempt) # exponential backoff
+    raise RuntimeError(f"{url}: {error}")
+
+
+downloads = []
 for location in ["NSW", "QLD", "VIC", "SA", "TAS"]:
     for year in range(2015, 2020+1): # sampling rate for 2021+ is different
         for month in ['01','02','03','04','05','06','07','08','09','10','11','12']:
             file_save_path = f"{save_folder}/{location}/{year}{month}.csv"
             os.makedirs(os.path.dirname(file_save_path), exist_ok=True)
-            bash_command = f"curl https://aemo.com.au/aemo/data/nem/priceanddemand/PRICE_AND_DEMAND_{year}{month}_{location}1.csv > {file_save_path}"
-            result = subprocess.run(bash_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            if result.returncode != 0:
-                print("Command failed:")
-                print(result.stderr)
-            else:
-                print(f"Downloaded {year}-{month}-{location}.csv")
+            url = f"https://aemo.com.au/aemo/data/nem/priceanddemand/PRICE_AND_DEMAND_{year}{month}_{location}1.csv"
+            downloads.append((url, file_save_path, f"{year}-{month}-{location}"))
+
+with ThreadPoolExecutor(max_workers=n_workers) as executor:
+    futures = {executor.submit(download, url, path): name for url, path, name in downloads}
+    for future in as_completed(futures):
+        try:
+            future.result()
+            print(f"Downloaded {futures[future]}.csv")
+        except RuntimeError as e:
+            print("Download failed:")
+            print(e)
@@ -33,8 +33,10 @@ def parse_args():
 
 def run(args):
     set_seed(args.seed)
-    train_data = pd.read_csv(args.raw_train_data_csv)
-    test_data = pd.read_csv(args.raw_test_data_csv)
+    # only the date and load columns are needed, parsed with the multithreaded pyarrow reader
+    usecols = [args.date_feature_name, args.trg_feature_name]
+    train_data = pd.read_csv(args.raw_train_data_csv, usecols=usecols, engine="pyarrow")
+    test_data = pd.read_csv(args.raw_test_data_csv, usecols=usecols, engine="pyarrow")
 
     train_data[args.date_feature_name] = pd.to_datetime(train_data[args.date_feature_name], format="%Y-%m-%d %H:%M:%S")
     test_data[args.date_feature_name] = pd.to_datetime(test_data[args.date_feature_name], format="%Y-%m-%d %H:%M:%S")
@@ -42,46 +44,27 @@ def run(args):
     train_data.set_index(args.date_feature_name, inplace=True)
     test_data.set_index(args.date_feature_name, inplace=True)
 
-    def extract_consec_days(data, day0, n_days, day_size):
-        """return n_days consecutive days starting at day0 from feat dataframe"""
-
-        sequence, gt = [], []
-        start = day0
-        end = start + day_size
-
-        for day in range(n_days):
-            sequence.extend(data[args.trg_feature_name].values[start: end])
-            start += day_size
-            end += day_size
-        return np.array(sequence), np.array(gt)
-
     def build_dataset(data, n_days, day_size, day_stride):
         """
-            build a dataset from feat dataframe using a sliding window of size n_days and stride of 1 day 
-            while contamining the data with synthetic anomalies
-        """        
-        time_wind = []
-        gt_time_wind = []
-        datetime_wind = []
-
-        day_idx = 0
-        while day_idx < len(data)//day_size - n_days:
-            day0 = day_idx*day_size
-            sequence, gt = extract_consec_days(data, day0, n_days, day_size)
-
-            time_wind.append(sequence)
-            gt_time_wind.append(gt)
-            first_date = str(data.index[day0]).replace(':', '')
-            last_date = str(data.index[day0 + n_days*day_size-1]).replace(':', '')
-            datetime_wind.append(f"{first_date} - {last_date}")
-
-            day_idx += day_stride
+            build a dataset from feat dataframe using a sliding window of size n_days and stride of day_stride days
+        """
+        feat = data[args.trg_feature_name].to_numpy()
+        win_size = n_days*day_size
+        step = day_stride*day_size
 
-        return time_wind, gt_time_wind, datetime_wind
+        starts = np.arange(0, len(data)//day_size - n_days, day_stride) * day_size
+        if not len(starts):
+            return np.empty((0, win_size)), []
+        time_wind = np.lib.stride_tricks.sliding_window_view(feat, win_size)[::step][:len(starts)]
+        datetime_wind = [
+            f"{str(data.index[day0]).replace(':', '')} - {str(data.index[day0 + win_size-1]).replace(':', '')}"
+            for day0 in starts
+        ]
+        return time_wind, datetime_wind
 
 
-    train_windows, gt_train_windows, date_train_windows = build_dataset(train_data, args.n_days, args.day_size, args.day_stride)
-    test_windows, _, date_test_windows = build_dataset(test_data, args.n_days, args.day_size, args.day_stride)
+    train_windows, date_train_windows = build_dataset(train_data, args.n_days, args.day_size, args.day_stride)
+    test_windows, date_test_windows = build_dataset(test_data, args.n_days, args.day_size, args.day_stride)
 
     # save data
     # remove existing files in save target root folder
@@ -90,20 +73,12 @@ def run(args):
     for f in existing_files:
         os.remove(f)
 
-    # crete save target folders if they don't exist
-    os.makedirs(os.path.join(args.trg_test_save_data, "data"), exist_ok=True)
-    os.makedirs(os.path.join(args.trg_train_save_data, "data"), exist_ok=True)
-    # os.makedirs(os.path.join(args.trg_train_save_data, "gt"), exist_ok=True)
-
-    # save data
-    for i, (sample, sample_date) in enumerate(zip(test_windows, date_test_windows)):
-        if np.isnan(sample).any(): continue
-        np.save(os.path.join(args.trg_test_save_data, "data", sample_date), sample)
-
-    for i, (sample, sample_gt, sample_date) in enumerate(zip(train_windows, gt_train_windows, date_train_windows)):
-        if np.isnan(sample).any(): continue
-        np.save(os.path.join(args.trg_train_save_data, "data", sample_date), sample)
-        # np.save(os.path.join(args.trg_train_save_data, "gt", sample_date), sample_gt)
+    # save each split as a single bundle of windows and their date ranges, skipping windows with missing values
+    for windows, date_windows, save_folder in [(test_windows, date_test_windows, args.trg_test_save_data),
+                                               (train_windows, date_train_windows, args.trg_train_save_data)]:
+        mask = ~np.isnan(windows).any(axis=1)
+        os.makedirs(save_folder, exist_ok=True)
+        np.savez(os.path.join(save_folder, "data.npz"), data=windows[mask], dates=np.array(date_windows, dtype=str)[mask])
 
     # log results
     os.makedirs(os.path.dirname(args.log_file), exist_ok=True)
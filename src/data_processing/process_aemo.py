@@ -1,6 +1,7 @@
 import os
 import argparse
 import glob
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 
@@ -210,17 +211,17 @@ def run(args):
     os.makedirs(os.path.join(args.trg_save_data, "ad_test_contam", "data"), exist_ok=True)
     os.makedirs(os.path.join(args.trg_save_data, "ad_test_contam", "gt"), exist_ok=True)
 
-    # save contam ad train data
-    for i, (sample, sample_gt, sample_date) in enumerate(zip(ad_train_windows, gt_ad_train_windows, date_ad_train_windows)):
-        if np.isnan(sample).any(): continue
-        np.save(os.path.join(args.trg_save_data, "ad_train_contam", "data", sample_date), sample)
-        np.save(os.path.join(args.trg_save_data, "ad_train_contam", "gt", sample_date), sample_gt)
-
-    # save contam ad test data
-    for i, (sample, sample_gt, sample_date) in enumerate(zip(ad_test_windows, gt_ad_test_windows, date_ad_test_windows)):
-        if np.isnan(sample).any(): continue
-        np.save(os.path.join(args.trg_save_data, "ad_test_contam", "data", sample_date), sample)
-        np.save(os.path.join(args.trg_save_data, "ad_test_contam", "gt", sample_date), sample_gt)
+    # save contam ad train/test data, one file per window, writes are overlapped in a thread pool since they are I/O-bound
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        futures = []
+        for split, split_windows, split_gt, split_dates in [("ad_train_contam", ad_train_windows, gt_ad_train_windows, date_ad_train_windows),
+                                                            ("ad_test_contam", ad_test_windows, gt_ad_test_windows, date_ad_test_windows)]:
+            for sample, sample_gt, sample_date in zip(split_windows, split_gt, split_dates):
+                if np.isnan(sample).any(): continue
+                futures.append(executor.submit(np.save, os.path.join(args.trg_save_data, split, "data", sample_date), sample))
+                futures.append(executor.submit(np.save, os.path.join(args.trg_save_data, split, "gt", sample_date), sample_gt))
+        for future in futures:
+            future.result() # raise write errors
 
     # log results
     os.makedirs(os.path.dirname(args.log_file), exist_ok=True)
@@ -1,8 +1,12 @@
 import os
 import argparse
 import glob
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 
 import sys
 sys.path.append("./src")
@@ -31,28 +35,61 @@ def parse_args():
     return args
 
 
+def _scan_raw_files(data_root, sampling_rate, building_type):
+    """yield the data_root/*/sampling_rate/*building_type/*.xlsx paths, hidden entries are skipped like glob does"""
+    with os.scandir(data_root) as sites:
+        for site in sites:
+            rate_dir = os.path.join(site.path, sampling_rate)
+            if site.name.startswith(".") or not site.is_dir() or not os.path.isdir(rate_dir): continue
+            with os.scandir(rate_dir) as buildings:
+                for building in buildings:
+                    if building.name.startswith(".") or not building.name.endswith(building_type) or not building.is_dir(): continue
+                    with os.scandir(building.path) as files:
+                        for file in files:
+                            if not file.name.startswith(".") and file.name.endswith(".xlsx") and file.is_file():
+                                yield file.path
+
+
+def _write_csv(path, index, columns):
+    """write columns indexed by date with pyarrow's multithreaded csv writer, much faster than DataFrame.to_csv"""
+    table = pa.table({"date": index.strftime("%Y-%m-%d %H:%M:%S").to_numpy(), **columns})
+    pa_csv.write_csv(table, path)
+
+
+def _read_one(csv_path, date_col, load_col):
+    """read one raw park file, return None if it has missing values, too many zeros or can't be read"""
+    try: 
+        try:
+            csv_file = pd.read_excel(csv_path, engine="calamine", usecols=[date_col, load_col]) # rust-based parser, much faster than openpyxl
+        except ImportError:
+            csv_file = pd.read_excel(csv_path, engine="openpyxl", usecols=[date_col, load_col])
+        csv_file = csv_file[[date_col, load_col]]
+        csv_file[load_col] = csv_file[load_col].astype(np.float32)
+        csv_file[date_col] = pd.to_datetime(csv_file[date_col], format="%Y-%m-%d %H:%M:%S")
+        na_perc = csv_file[load_col].isna().sum()/len(csv_file[load_col])
+        zeros_perc = (csv_file[load_col] == 0).sum()/len(csv_file[load_col])
+        if na_perc > 0 or zeros_perc>0.05: return None
+        return csv_file
+    except Exception as e:
+        print(e)
+        return None
+
+
 def run(args):
     set_seed(args.seed)
-    load = pd.DataFrame()
     sampling_rate = os.path.basename(args.raw_data_root)
     building_type = os.path.basename(os.path.dirname(args.raw_data_root))
     data_root = os.path.dirname(os.path.dirname(args.raw_data_root))
 
-    csv_paths = glob.iglob(os.path.join(data_root, '*', sampling_rate, f"*{building_type}", "*.xlsx"))
-
-    for csv_path in csv_paths:
-        try: 
-            csv_file = pd.read_excel(csv_path)
-            csv_file = csv_file[[args.date_feature_name, args.load_feature_name]]
-            csv_file[args.date_feature_name] = pd.to_datetime(csv_file[args.date_feature_name], format="%Y-%m-%d %H:%M:%S")
-            na_perc = csv_file[args.load_feature_name].isna().sum()/len(csv_file[args.load_feature_name])
-            zeros_perc = (csv_file[args.load_feature_name] == 0).sum()/len(csv_file[args.load_feature_name])
-            if na_perc > 0 or zeros_perc>0.05: continue
-        except Exception as e:
-            print(e)
-        load = pd.concat([load, csv_file], axis=0)
+    csv_paths = _scan_raw_files(data_root, sampling_rate, building_type)
+
+    # excel parsing is CPU-bound, read the files in parallel
+    with ProcessPoolExecutor() as executor:
+        read_one = partial(_read_one, date_col=args.date_feature_name, load_col=args.load_feature_name)
+        frames = [csv_file for csv_file in executor.map(read_one, csv_paths) if csv_file is not None]
     
-    if len(load) == 0: raise Exception("No data found!")
+    if len(frames) == 0: raise Exception("No data found!")
+    load = pd.concat(frames, axis=0)
 
     load.set_index(args.date_feature_name, inplace=True)
     load.sort_index(inplace=True)
@@ -63,142 +100,124 @@ def run(args):
     # fill missing values
     idx = pd.date_range(load.index[0], load.index[-1], freq="30T") # TODO: make frequency dynamic
     load = load.reindex(idx, fill_value=np.nan)
-    load = fill_missing_values(load, args.day_size)
+    load = fill_missing_values(load, args.day_size).astype(np.float32) # KNN imputation returns float64
     
     # split contam data into train and test sets for anomaly detection model
     N = int(args.contam_clean_ratio*len(load))//args.day_size*args.day_size
 
+    load_vals = load[args.load_feature_name].to_numpy() # raw values, contaminated below without pandas indexing
     contaminated_load = load[:N]
     clean_load = load[N:]
     ad_load = contaminated_load.copy()
 
     # contaminate data with synthetic anomalies    
     anomaly_generator = SynthLoadAnomaly()
-    print(f"Anomaly generator probabilities: {anomaly_generator.prob_1}, {anomaly_generator.prob_2}, {anomaly_generator.prob_3}, {anomaly_generator.prob_4}, {anomaly_generator.prob_softstart}, {anomaly_generator.prob_extreme}", file=open(args.log_file, "a"))
+    with open(args.log_file, "a") as lf:
+        print(f"Anomaly generator probabilities: {anomaly_generator.prob_1}, {anomaly_generator.prob_2}, {anomaly_generator.prob_3}, {anomaly_generator.prob_4}, {anomaly_generator.prob_softstart}, {anomaly_generator.prob_extreme}", file=lf)
     
-    def contam_load(load, anomaly_generator, day_contam_rate, data_contam_rate, feature_name, day_size, seed=0):
-        """contaminate load dataframe with synthetic anomalies"""
+    def contam_load(vals, anomaly_generator, day_contam_rate, data_contam_rate, day_size, seed=0):
+        """contaminate load values (1D array) with synthetic anomalies, returns a contaminated copy and the gt"""
 
+        vals = np.array(vals) # owned writable buffer, pandas may return read-only views (copy-on-write)
         np.random.seed(seed)
         anomaly_generator.__init__(seed=seed) # set seed and reset probabilties (modified later in the function)
 
-        gt = np.zeros(len(load))
-        n_days = len(load)//day_size
-        n_contam_days = int(day_contam_rate*len(load)//day_size)
-        contam_days = np.random.choice(range(0, len(load)//day_size), n_contam_days, replace=False)
+        gt = np.zeros(len(vals), dtype=np.uint8)
+        n_days = len(vals)//day_size
+        n_contam_days = int(day_contam_rate*len(vals)//day_size)
+        contam_days = np.random.choice(range(0, len(vals)//day_size), n_contam_days, replace=False)
         
         cur_contam = 0
         cur_contam_days = 0
-        trg_contam = int(data_contam_rate*len(load))
+        trg_contam = int(data_contam_rate*len(vals))
         
         # calculate average anomaly length for type 1 and type 2 anomalies to achieve the target contamination rate
         avg_anom_1_length = (trg_contam - n_contam_days*anomaly_generator.prob_3 - n_contam_days*anomaly_generator.prob_4) / ((anomaly_generator.prob_1 + anomaly_generator.prob_2) / anomaly_generator.prob_1) / (n_contam_days * anomaly_generator.prob_1)
         avg_anom_2_length = (trg_contam - n_contam_days*anomaly_generator.prob_3 - n_contam_days*anomaly_generator.prob_4) / ((anomaly_generator.prob_1 + anomaly_generator.prob_2) / anomaly_generator.prob_2) / (n_contam_days * anomaly_generator.prob_2)
         anom1_len_var = avg_anom_1_length/2
         anom2_len_var = avg_anom_2_length/2
-        print(f"avg_anom_1_length: {avg_anom_1_length}, avg_anom_2_length: {avg_anom_2_length}", file=open(args.log_file, "a"))
+        with open(args.log_file, "a") as lf:
+            print(f"avg_anom_1_length: {avg_anom_1_length}, avg_anom_2_length: {avg_anom_2_length}", file=lf)
         
-        for day in range(n_days):
-            day_st = day*day_size
-            day_end = day_st + day_size
-            seq_gt = gt[day_st: day_end]
-
-            if day in contam_days:
-                if cur_contam_days >= n_contam_days*0.9:
-                    # for the last chunk of data, we contaminate with the exact number of anomalies needed to reach the target contamination rate
-                    avg_anom_1_length = (trg_contam - cur_contam) / ((anomaly_generator.prob_1 + anomaly_generator.prob_2) / anomaly_generator.prob_1) / ((n_contam_days - cur_contam_days) * anomaly_generator.prob_1)
-                    avg_anom_2_length = (trg_contam - cur_contam) / ((anomaly_generator.prob_1 + anomaly_generator.prob_2) / anomaly_generator.prob_2) / ((n_contam_days - cur_contam_days) * anomaly_generator.prob_2)
-                    anom1_len_var = 0
-                    anom2_len_var = 0
-                    anomaly_generator.prob_1 += anomaly_generator.prob_3
-                    anomaly_generator.prob_2 += anomaly_generator.prob_4
-                    anomaly_generator.prob_3 = 0
-                    anomaly_generator.prob_4 = 0
-                
-                # contaminate day randomly (anomaly probabilities are given to the generator)
-                sequence = load[feature_name].values[day_st: day_end]
-                anomalous_sequence, anom_idx = anomaly_generator.inject_anomaly(sequence, 1,
-                                                                                avg_anom_1_length, anom1_len_var,
-                                                                                avg_anom_2_length, anom2_len_var)
-                load[feature_name].values[day_st: day_end] = anomalous_sequence
-
-                # update gt
-                for anom_id in anom_idx: 
-                    if not seq_gt[anom_id]: # handles adding anomalies to contaminated load (not implemented)
-                        seq_gt[anom_id] = 1 
-                        cur_contam += 1
-                cur_contam_days += 1
-
-            gt[day_st: day_end] = seq_gt
-
-            if cur_contam >= trg_contam: 
-                break
+        # (n_days, day_size) views, only the contaminated days are visited (in chronological order)
+        days = vals[:n_days*day_size].reshape(n_days, day_size)
+        days_gt = gt[:n_days*day_size].reshape(n_days, day_size)
 
-        return load, gt
+        for day in np.sort(contam_days):
+            if day > 0 and cur_contam >= trg_contam:
+                break
 
-    def extract_consec_days(load, gt_load, day0, n_days, day_size):
-        """return n_days consecutive days starting at day0 from load dataframe"""
+            if cur_contam_days >= n_contam_days*0.9:
+                # for the last chunk of data, we contaminate with the exact number of anomalies needed to reach the target contamination rate
+                avg_anom_1_length = (trg_contam - cur_contam) / ((anomaly_generator.prob_1 + anomaly_generator.prob_2) / anomaly_generator.prob_1) / ((n_contam_days - cur_contam_days) * anomaly_generator.prob_1)
+                avg_anom_2_length = (trg_contam - cur_contam) / ((anomaly_generator.prob_1 + anomaly_generator.prob_2) / anomaly_generator.prob_2) / ((n_contam_days - cur_contam_days) * anomaly_generator.prob_2)
+                anom1_len_var = 0
+                anom2_len_var = 0
+                anomaly_generator.prob_1 += anomaly_generator.prob_3
+                anomaly_generator.prob_2 += anomaly_generator.prob_4
+                anomaly_generator.prob_3 = 0
+                anomaly_generator.prob_4 = 0
+            
+            # contaminate day randomly (anomaly probabilities are given to the generator)
+            anomalous_sequence, anom_idx = anomaly_generator.inject_anomaly(days[day], 1,
+                                                                            avg_anom_1_length, anom1_len_var,
+                                                                            avg_anom_2_length, anom2_len_var)
+            days[day] = anomalous_sequence
 
-        sequence, gt = [], []
-        start = day0
-        end = start + day_size
+            # update gt, only newly flagged points count towards the contamination
+            anom_idx = np.unique(np.asarray(anom_idx, dtype=np.intp))
+            cur_contam += len(anom_idx) - np.count_nonzero(days_gt[day, anom_idx])
+            days_gt[day, anom_idx] = 1
+            cur_contam_days += 1
 
-        for day in range(n_days):
-            sequence.extend(load[args.load_feature_name].values[start: end])
-            gt.extend(gt_load[start: end])
-            start += day_size
-            end += day_size
-        return np.array(sequence), np.array(gt)
+        return vals, gt
 
     def build_dataset(load, n_days, day_size, day_stride, contam_data=True):
         """
             build a dataset from load dataframe using a sliding window of size n_days and stride of 1 day 
             while contamining the data with synthetic anomalies
         """
+        vals = load[args.load_feature_name].to_numpy()
         if contam_data:
-            load, gt_load = contam_load(load, anomaly_generator, args.day_contam_rate, args.data_contam_rate, args.load_feature_name, day_size, args.seed)
+            vals, gt_load = contam_load(vals, anomaly_generator, args.day_contam_rate, args.data_contam_rate, day_size, args.seed)
+            load[args.load_feature_name] = vals
         else:
-            gt_load = [[0]*day_size]*(len(load)//day_size)
+            gt_load = np.zeros(len(vals), dtype=np.uint8)
         
-        time_wind = []
-        gt_time_wind = []
-        datetime_wind = []
-
-        day_idx = 0
-        while day_idx < len(load)//day_size - n_days:
-            day0 = day_idx*day_size
-            sequence, gt = extract_consec_days(load, gt_load, day0, n_days, day_size)
-
-            time_wind.append(sequence)
-            gt_time_wind.append(gt)
-            first_date = str(load.index[day0]).replace(':', '')
-            last_date = str(load.index[day0 + n_days*day_size-1]).replace(':', '')
-            datetime_wind.append(f"{first_date} - {last_date}")
-            day_idx += day_stride
+        # windows of n_days consecutive days every day_stride days, as zero-copy views over the series
+        window_size = n_days*day_size
+        starts = np.arange(0, len(load)//day_size - n_days, day_stride)*day_size
+        time_wind = np.lib.stride_tricks.sliding_window_view(vals, window_size)[::day_stride*day_size][:len(starts)]
+        gt_time_wind = np.lib.stride_tricks.sliding_window_view(np.asarray(gt_load), window_size)[::day_stride*day_size][:len(starts)]
+
+        # same format as str(timestamp) without ':', formatted in one vectorized pass
+        first_dates = load.index[starts].strftime("%Y-%m-%d %H%M%S")
+        last_dates = load.index[starts + window_size-1].strftime("%Y-%m-%d %H%M%S")
+        datetime_wind = [f"{first_date} - {last_date}" for first_date, last_date in zip(first_dates, last_dates)]
 
         return time_wind, gt_time_wind, datetime_wind
 
     ts_windows, gt_windows, date_windows = build_dataset(ad_load, args.n_days, args.day_size, args.day_stride, contam_data=True)
     
+    valid_windows = ~np.isnan(ts_windows).any(axis=1) # windows with missing values are not saved, masked in one pass
+    
     M = int(args.ad_split_ratio*len(ts_windows))
     ad_train_windows, ad_test_windows = ts_windows[:M], ts_windows[M:]
     gt_ad_train_windows, gt_ad_test_windows = gt_windows[:M], gt_windows[M:]
     date_ad_train_windows, date_ad_test_windows = date_windows[:M], date_windows[M:]
 
-    datapoint_contam_ratio = np.array(gt_ad_train_windows+gt_ad_test_windows).sum() / (len(gt_ad_train_windows+gt_ad_test_windows)*args.day_size)
+    datapoint_contam_ratio = gt_windows.sum() / (len(gt_windows)*args.day_size)
 
     # normalize data
     min_quantile = 0.01
     max_quantile = 0.99
 
-    min_q_val = clean_load.quantile(min_quantile).item()
-    max_q_val = clean_load.quantile(max_quantile).item()
+    min_q_val, max_q_val = np.nanquantile(clean_load[args.load_feature_name].to_numpy(), [min_quantile, max_quantile]).tolist() # both bounds in one pass, NaNs skipped like pandas
 
-    def scale_windows(windows_list, min_q_val, max_q_val):
-        scaled_windows = []
-        for window in windows_list:
-            window = (window - min_q_val) / (max_q_val - min_q_val)
-            scaled_windows.append(window)
+    def scale_windows(windows, min_q_val, max_q_val):
+        """min-max scale an array (e.g. a (n_windows, window_size) matrix) in one broadcasted pass, returns a new array"""
+        scaled_windows = np.subtract(windows, min_q_val)
+        scaled_windows *= 1 / (max_q_val - min_q_val)
         return scaled_windows
 
     ad_train_windows = scale_windows(ad_train_windows, min_q_val, max_q_val)
@@ -212,47 +231,36 @@ def run(args):
 
     # create save target folders if they don't exist
     os.makedirs(os.path.join(args.trg_save_data, "lf_test_clean", "data"), exist_ok=True)
-    os.makedirs(os.path.join(args.trg_save_data, "ad_train_contam", "data"), exist_ok=True)
-    os.makedirs(os.path.join(args.trg_save_data, "ad_train_contam", "gt"), exist_ok=True)
-    os.makedirs(os.path.join(args.trg_save_data, "ad_test_contam", "data"), exist_ok=True)
-    os.makedirs(os.path.join(args.trg_save_data, "ad_test_contam", "gt"), exist_ok=True)
-
-    # save contam ad train data
-    for i, (sample, sample_gt, sample_date) in enumerate(zip(ad_train_windows, gt_ad_train_windows, date_ad_train_windows)):
-        if np.isnan(sample).any(): continue
-        np.save(os.path.join(args.trg_save_data, "ad_train_contam", "data", sample_date), sample)
-        np.save(os.path.join(args.trg_save_data, "ad_train_contam", "gt", sample_date), sample_gt)
-
-    # save contam ad test data
-    for i, (sample, sample_gt, sample_date) in enumerate(zip(ad_test_windows, gt_ad_test_windows, date_ad_test_windows)):
-        if np.isnan(sample).any(): continue
-        np.save(os.path.join(args.trg_save_data, "ad_test_contam", "data", sample_date), sample)
-        np.save(os.path.join(args.trg_save_data, "ad_test_contam", "gt", sample_date), sample_gt)
+    os.makedirs(os.path.join(args.trg_save_data, "ad_train_contam"), exist_ok=True)
+    os.makedirs(os.path.join(args.trg_save_data, "ad_test_contam"), exist_ok=True)
+
+    # save contam ad train/test data, one bundle per split with the windows, their gt and date ranges
+    for split, split_windows, split_gt, split_dates, keep in [("ad_train_contam", ad_train_windows, gt_ad_train_windows, date_ad_train_windows, valid_windows[:M]),
+                                                              ("ad_test_contam", ad_test_windows, gt_ad_test_windows, date_ad_test_windows, valid_windows[M:])]:
+        np.savez(os.path.join(args.trg_save_data, split, "data.npz"), data=split_windows[keep], gt=split_gt[keep], dates=np.asarray(split_dates)[keep])
 
     # log results
     os.makedirs(os.path.dirname(args.log_file), exist_ok=True)
-    print(args, file=open(args.log_file, "a"))
-    print(f"Number of ad_train_contam windows: {len(ad_train_windows)}", file=open(args.log_file, "a"))
-    print(f"Number of ad_test_contam windows: {len(ad_test_windows)}", file=open(args.log_file, "a"))
+    with open(args.log_file, "a") as lf:
+        print(args, file=lf)
+        print(f"Number of ad_train_contam windows: {len(ad_train_windows)}", file=lf)
+        print(f"Number of ad_test_contam windows: {len(ad_test_windows)}", file=lf)
 
-    print(f"{args.day_contam_rate*100:.2f}% of days are contaminated.", file=open(args.log_file, "a"))
-    print(f"{datapoint_contam_ratio*100:.2f}% of datapoints are contaminated.", file=open(args.log_file, "a"))
+        print(f"{args.day_contam_rate*100:.2f}% of days are contaminated.", file=lf)
+        print(f"{datapoint_contam_ratio*100:.2f}% of datapoints are contaminated.", file=lf)
 
-    print(f"min_quantile={min_quantile:0.3f} -> value={min_q_val}", file=open(args.log_file, "a"))
-    print(f"max_quantile={max_quantile:0.3f} -> value={max_q_val}", file=open(args.log_file, "a"))
+        print(f"min_quantile={min_quantile:0.3f} -> value={min_q_val}", file=lf)
+        print(f"max_quantile={max_quantile:0.3f} -> value={max_q_val}", file=lf)
 
     # save clean load for forecasting model evaluation
-    clean_load = (clean_load - min_q_val) / (max_q_val - min_q_val)
-    clean_load.rename_axis("date", inplace=True)
-    clean_load.to_csv(os.path.join(args.trg_save_data, "load_clean_lf_test.csv"))
+    clean_vals = scale_windows(clean_load[args.load_feature_name].to_numpy(), min_q_val, max_q_val)
+    _write_csv(os.path.join(args.trg_save_data, "load_clean_lf_test.csv"), clean_load.index, {args.load_feature_name: clean_vals})
 
     # save contaminated load serie to infer AD/AI models after training
-    contam_full_load, gt_full_load = contam_load(contaminated_load, anomaly_generator, args.day_contam_rate, args.data_contam_rate, args.load_feature_name, args.day_size, args.seed+1) # for a more realistic scenario, data contamination here is different than for the AD model's training. AD is unsupervised anyway.
-    scaled_load = (contam_full_load - min_q_val) / (max_q_val - min_q_val)
-    scaled_load.rename_axis("date", inplace=True)
-    scaled_load.to_csv(os.path.join(args.trg_save_data, "load_contam.csv"))
-    gt_full_load = pd.Series(gt_full_load, index=scaled_load.index[:len(gt_full_load)]).rename("gt", inplace=True)
-    pd.Series(gt_full_load).to_csv(os.path.join(args.trg_save_data, "load_contam_gt.csv"))
+    contam_full_vals, gt_full_load = contam_load(load_vals[:N], anomaly_generator, args.day_contam_rate, args.data_contam_rate, args.day_size, args.seed+1) # for a more realistic scenario, data contamination here is different than for the AD model's training. AD is unsupervised anyway.
+    scaled_vals = scale_windows(contam_full_vals, min_q_val, max_q_val)
+    _write_csv(os.path.join(args.trg_save_data, "load_contam.csv"), contaminated_load.index, {args.load_feature_name: scaled_vals})
+    _write_csv(os.path.join(args.trg_save_data, "load_contam_gt.csv"), contaminated_load.index[:len(gt_full_load)], {"gt": gt_full_load})
     print('Dataset ready!')
 
     return min_q_val, max_q_val
@@ -1,4 +1,35 @@
 import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def _type1_kernel(target, idx, length, k):
+    energy_at_start = target[:idx].sum() + k
+    energy_at_end = target[:idx + length].sum() + k
+    target[idx] = -1 * energy_at_start
+    target[idx + 1:idx + length - 1] = 0
+    target[idx + length - 1] = energy_at_end
+
+
+@njit(cache=True)
+def _type2_kernel(target, idx, length, r, softstart):
+    energy_consumed = target[idx:idx + length].sum()
+    if softstart:
+        target[idx] = r * target[idx]
+        target[idx + 1:idx + length - 1] = 0
+        target[idx + length - 1] = energy_consumed - target[idx]
+    else:
+        target[idx:idx + length - 1] = 0
+        target[idx + length - 1] = energy_consumed
+
+
+@njit(cache=True)
+def _peak_kernel(target, idx, sign, r, is_extreme, k):
+    """negative (sign=-1, type 3) or positive (sign=1, type 4) peak"""
+    if is_extreme:
+        target[idx] = sign * target[:idx].sum() - k
+    else:
+        target[idx] = sign * r * target[idx - 1]
 
 
 class SynthLoadAnomaly():
@@ -34,11 +65,8 @@ class SynthLoadAnomaly():
                 raise Exception("Type 1 power anomalies must be longer than 2.")
             else:
                 # WARNING: This could lead to a overflow quite fast?
-                energy_at_start = target[:idx].sum() + k
-                energy_at_end = target[:idx + length].sum() + k
-                target[idx] = -1 * energy_at_start          # replace first by negative peak
-                target[idx + 1:idx + length - 1] = 0        # set other values to zero
-                target[idx + length - 1] = energy_at_end    # replace last with sum of missing values + k
+                # replace first by negative peak, set other values to zero and replace last with sum of missing values + k
+                _type1_kernel(target, idx, length, k)
         return target
 
 
@@ -51,16 +79,8 @@ class SynthLoadAnomaly():
             if length <= 1:
                 raise Exception("Type 2 power anomalies must be longer than 1.")
             else:
-                if softstart:
-                    r = np.random.rand()
-                    energy_consumed = target[idx:idx + length].sum()
-                    target[idx] = r * target[idx]
-                    target[idx + 1:idx + length - 1] = 0
-                    target[idx + length - 1] = energy_consumed - target[idx]
-                else:
-                    energy_consumed = target[idx:idx + length].sum()
-                    target[idx:idx + length - 1] = 0
-                    target[idx + length - 1] = energy_consumed
+                r = np.random.rand() if softstart else 0.0
+                _type2_kernel(target, idx, length, r, bool(softstart))
         return target
 
 
@@ -73,12 +93,8 @@ class SynthLoadAnomaly():
             if length > 1:
                 raise Exception("Type 3 power anomalies can't be longer than 1.")
             else:
-                if is_extreme:
-                    energy_consumed = target[:idx].sum()
-                    target[idx] = -1 * energy_consumed - k
-                else:
-                    r = np.random.uniform(*range_r)
-                    target[idx] = -1 * r * target[idx - 1]
+                r = 0.0 if is_extreme else np.random.uniform(*range_r)
+                _peak_kernel(target, idx, -1, r, bool(is_extreme), k)
         return target
 
 
@@ -91,12 +107,8 @@ class SynthLoadAnomaly():
             if length > 1:
                 raise Exception("Type 4 power anomalies can't be longer than 1.")
             else:
-                if is_extreme:
-                    energy_consumed = target[:idx].sum()
-                    target[idx] = energy_consumed - k
-                else:
-                    r = np.random.uniform(*range_r)
-                    target[idx] = r * target[idx - 1]
+                r = 0.0 if is_extreme else np.random.uniform(*range_r)
+                _peak_kernel(target, idx, 1, r, bool(is_extreme), k)
         return target
 
 
@@ -218,7 +218,7 @@ class ModelWrapper():
 
     def predict(self, inputs):
         self.model.eval()
-        with torch.no_grad():
+        with torch.inference_mode(): # outputs are only used for evaluation/plotting
             if self.args.stacks == 1:
                 outputs = self.model(inputs)
             elif self.args.stacks == 2:
@@ -10,22 +10,20 @@ class DatasetForecasting(torch.utils.data.Dataset):
     def __init__(self, root_dir, ts_split=0.7, return_date=False):
         super().__init__()
         self.root_dir = root_dir
-        self.npy_paths = self.load_data()
+        self.windows, self.date_ranges = self.load_data()
         self.ts_split = ts_split # Ratio of input to target (forecasting horizon) split"
         self.return_date = return_date
 
     def __getitem__(self, idx):
-        data = np.load(self.npy_paths[idx])
-        data = torch.tensor(data, dtype=torch.float)
+        data = self.windows[idx]
         if data.dim() == 1: data = data.unsqueeze(1) # add dimensions here if necessary
         seq_len = int(data.shape[0]*self.ts_split)
 
         if not self.return_date:
             return data[:seq_len, :], data[seq_len:, :]
 
-        # infer dates from file name for plotting and interpretation purposes (test set only)
-        date_range = os.path.basename(self.npy_paths[idx]).replace(".npy", "")
-        first_date, last_date = date_range.split(" - ")
+        # infer dates from the window's date range for plotting and interpretation purposes (test set only)
+        first_date, last_date = self.date_ranges[idx].split(" - ")
         first_date = first_date.split("_")[0]
         last_date = last_date.split("_")[0]
         dates = pd.date_range(first_date, last_date, freq="1D")
@@ -34,10 +32,18 @@ class DatasetForecasting(torch.utils.data.Dataset):
         return dates, data[:seq_len, :], data[seq_len:, :]
 
     def __len__(self):
-        return len(self.npy_paths)
+        return len(self.date_ranges)
 
     def load_data(self):
-        npy_paths = glob.glob(os.path.join(self.root_dir, "data", "*.npy"))
-        if not len(npy_paths): 
+        """Preloads all windows in a single float tensor, from the windows bundle (data.npz) if present, otherwise from one .npy file per window."""
+        bundle_path = os.path.join(self.root_dir, "data.npz")
+        if os.path.exists(bundle_path):
+            with np.load(bundle_path) as bundle:
+                windows, date_ranges = bundle["data"], bundle["dates"].tolist()
+        else:
+            npy_paths = glob.glob(os.path.join(self.root_dir, "data", "*.npy"))
+            windows = [np.load(npy_path) for npy_path in npy_paths]
+            date_ranges = [os.path.basename(npy_path).replace(".npy", "") for npy_path in npy_paths]
+        if not len(windows): 
             raise ValueError("No data found in the specified directory")
-        return npy_paths
+        return torch.from_numpy(np.stack(windows).astype(np.float32, copy=False)), date_ranges
@@ -30,6 +30,7 @@ def parse_args():
     parser.add_argument("--patience",               type=int,       default=50,       help="Patience for early stopping")
     parser.add_argument("--batch_size",             type=int,       default=32,       help="Batch size")
     parser.add_argument("--lr",                     type=float,     default=1e-3,     help="Learning rate")
+    parser.add_argument("--num_workers",            type=int,       default=4,        help="Number of data loading workers")
     parser.add_argument("--seed",                   type=int,       default=0)
     parser.add_argument("--checkpoint_path",        type=str,       default="src/forecasting/checkpoint.pt",       help="Path to save checkpoint")
     parser.add_argument("--verbose",                type=bool,      default=True,     help="Verbosity")
@@ -76,6 +77,12 @@ def get_data_loaders(args):
     train_data = DatasetForecasting(args.train_dataset_path, ts_split=args.sequence_split)
     test_data = DatasetForecasting(args.test_dataset_path, ts_split=args.sequence_split, return_date=True)
     valid_data, test_data = torch.utils.data.random_split(test_data, [int(0.5*len(test_data)), len(test_data) - int(0.5*len(test_data))])
+    # loaders are iterated every epoch/evaluation, keep their workers alive between iterations
+    workers_kwargs = dict(
+        num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+        prefetch_factor=4 if args.num_workers > 0 else None,
+    )
 
     trainloader = DataLoader(
         train_data,
@@ -83,6 +90,7 @@ def get_data_loaders(args):
         shuffle=True,
         pin_memory=True,
         drop_last=True,
+        **workers_kwargs,
     )
     validloader = DataLoader(
         valid_data,
@@ -90,6 +98,7 @@ def get_data_loaders(args):
         shuffle=True,
         pin_memory=True,
         drop_last=True,
+        **workers_kwargs,
     )
     testloader = DataLoader(
         test_data,
@@ -97,6 +106,7 @@ def get_data_loaders(args):
         shuffle=False,
         pin_memory=True,
         drop_last=True,
+        **workers_kwargs,
     ) 
     return trainloader, validloader, testloader, N_input, N_output
 
@@ -108,15 +118,16 @@ def plot_predictions(model, testloader, args, device, N_input, N_output, save_np
 
     for dates, inputs, targets in testloader:
         dates = np.array(dates)
-        inputs  = inputs.to(device)
-        targets = targets.to(device)
-        preds = model.predict(inputs)
+        # inputs and targets are plotted from the loader's host tensors, only the predictions are copied back from the device
+        inputs_np, targets_np = inputs.numpy(), targets.numpy()
+        preds = model.predict(inputs.to(device=device, dtype=torch.float32, non_blocking=True))
+        preds_np = preds.cpu().numpy()
         for i in range(args.batch_size):
             # if count == args.n_plots:
             #     return
-            input = inputs.detach().cpu().numpy()[i,:,:]
-            target = targets.detach().cpu().numpy()[i,:,:]
-            pred = preds.detach().cpu().numpy()[i,:,:]
+            input = inputs_np[i,:,:]
+            target = targets_np[i,:,:]
+            pred = preds_np[i,:,:]
             plt.plot(range(0, N_input), input, label='Model Input', linewidth=3)
             plt.plot(range(N_input-1, N_input+N_output), np.concatenate([input[N_input-1:N_input], target]), label='Target (GT)', linewidth=3)   
             plt.plot(range(N_input-1, N_input+N_output),  np.concatenate([input[N_input-1:N_input], pred]), label='Prediction', linewidth=3)       
@@ -128,8 +128,8 @@ class ModelWrapper():
 
     def predict(self, inputs):
         self.model.eval()
-        with torch.no_grad():
+        with torch.inference_mode(): # outputs are only used for evaluation/plotting
             if not isinstance(inputs, torch.Tensor):
-                inputs = torch.tensor(inputs).to(self.device)
+                inputs = torch.as_tensor(inputs, dtype=torch.float32, device=self.device)
             outputs = self.model(inputs)
         return outputs
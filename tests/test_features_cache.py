@@ -0,0 +1,88 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("faiss")
+pytest.importorskip("sklearn")
+pytest.importorskip("statsmodels")
+pytest.importorskip("tqdm")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "anomaly_detection"))
+
+import common
+import sampler
+import softpatch
+from dataset_ad import DatasetAnomalyDetection
+
+
+WINDOW_SIZE = 48
+FEATURE_DIM = 8
+
+
+def make_dataloader(root_dir):
+    rng = np.random.default_rng(0)
+    data = rng.random((10, WINDOW_SIZE), dtype=np.float32)
+    np.savez(
+        os.path.join(root_dir, "data.npz"),
+        data=data,
+        gt=np.zeros_like(data, dtype=np.uint8),
+        dates=np.array([f"window {i}" for i in range(len(data))]),
+    )
+    dataset = DatasetAnomalyDetection([str(root_dir)])
+    return torch.utils.data.DataLoader(dataset, batch_size=5, shuffle=False)
+
+
+def make_model(cache_dir, embed_calls, bank_features):
+    """SoftPatch with a stub embedding, enough to run the memory bank filling on CPU."""
+    device = torch.device("cpu")
+    model = softpatch.SoftPatch(device)
+    model.backbone = torch.nn.Identity()
+    model.layers_to_extract_from = ("layer2",)
+    model.patch_maker = softpatch.PatchMaker(3, stride=1)
+    model.input_shape = (1, WINDOW_SIZE)
+    model.feat_patch_size = 4
+    model.alpha = 0.5
+    model.forward_modules = torch.nn.ModuleDict({"preprocessing": common.Preprocessing([FEATURE_DIM], FEATURE_DIM)})
+    model.target_embed_dimension = FEATURE_DIM
+    model.threshold = 0.15
+    model.featuresampler = sampler.WeightedGreedyCoresetSampler(0.5, device)
+    model.anomaly_scorer = common.NearestNeighbourScorer(n_nearest_neighbours=1, nn_method=common.FaissNN(False, 1))
+    model.features_cache_dir = str(cache_dir)
+
+    def embed(timeseries, detach=True, provide_patch_shapes=False):
+        embed_calls.append(len(timeseries))
+        n_patches = WINDOW_SIZE // FEATURE_DIM
+        features = timeseries.reshape(len(timeseries) * n_patches, FEATURE_DIM)
+        return features, [[n_patches, 1]]
+
+    model._embed = embed
+    def compute_patch_weight(features):
+        bank_features.append(features.clone())
+        return torch.linspace(0, 1, len(features))
+
+    model._compute_patch_weight = compute_patch_weight
+    return model
+
+
+def test_second_fit_loads_cached_features(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    cache_dir = tmp_path / "cache"
+    dataloader = make_dataloader(data_dir)
+
+    first_calls, first_features = [], []
+    first_model = make_model(cache_dir, first_calls, first_features)
+    first_model.fit(dataloader)
+    assert first_calls
+    assert len(os.listdir(cache_dir)) == 2
+
+    second_calls, second_features = [], []
+    second_model = make_model(cache_dir, second_calls, second_features)
+    second_model.fit(dataloader)
+    assert second_calls == []
+    assert list(second_model.feature_shape) == list(first_model.feature_shape)
+    # the memory bank handed to the patch weighting is what the cache stores
+    assert torch.equal(second_features[0], first_features[0])